@@ -16,10 +16,24 @@ import sys
 sys.path.insert(0, '/opt/airflow/scripts')
 
 import os
-from spotify_extractor import extract_spotify_data
-from duckdb_loader import load_to_duckdb
 from utils import validate_env_vars
-from load_extended_history import load_extended_streaming_history
+
+
+# The task modules pull in spotipy, pandas and duckdb, so they are imported when
+# a task runs rather than every time the scheduler parses this file
+def extract_task():
+    from spotify_extractor import extract_spotify_data
+    return extract_spotify_data()
+
+
+def load_task():
+    from duckdb_loader import load_to_duckdb
+    return load_to_duckdb()
+
+
+def load_extended_task():
+    from load_extended_history import load_extended_streaming_history
+    return load_extended_streaming_history()
 
 
 def send_slack_alert(message):
@@ -97,14 +111,14 @@ validate_env = PythonOperator(
 # Task 2: Extract from Spotify API
 extract_data = PythonOperator(
     task_id='extract_spotify_data',
-    python_callable=extract_spotify_data,
+    python_callable=extract_task,
     dag=dag,
 )
 
 # Task 3: Load to DuckDB
 load_data = PythonOperator(
     task_id='load_to_duckdb',
-    python_callable=load_to_duckdb,
+    python_callable=load_task,
     pool='duckdb_pool',  # Ensure only one DuckDB task runs at a time
     pool_slots=1,
     dag=dag,
@@ -113,7 +127,7 @@ load_data = PythonOperator(
 # Task 4: Load extended streaming history (optional, runs once)
 load_extended = PythonOperator(
     task_id='load_extended_history',
-    python_callable=load_extended_streaming_history,
+    python_callable=load_extended_task,
     pool='duckdb_pool',  # Ensure only one DuckDB task runs at a time
     pool_slots=1,
     dag=dag,
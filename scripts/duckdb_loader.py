@@ -7,14 +7,15 @@ import os
 import logging
 import re
 from pathlib import Path
+from utils import write_watermark
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
-def validate_csv_path(file_path: str) -> str:
+def validate_parquet_path(file_path: str) -> str:
     """
-    Validate and sanitize CSV file path to prevent SQL injection.
+    Validate and sanitize Parquet file path to prevent SQL injection.
     Returns the absolute path if valid, raises ValueError if invalid.
     """
     # Resolve to absolute path
@@ -25,8 +26,8 @@ def validate_csv_path(file_path: str) -> str:
         raise ValueError(f"File does not exist: {abs_path}")
 
     # Check file extension
-    if not abs_path.lower().endswith('.csv'):
-        raise ValueError(f"File is not a CSV: {abs_path}")
+    if not abs_path.lower().endswith('.parquet'):
+        raise ValueError(f"File is not a Parquet file: {abs_path}")
 
     # Check for SQL injection characters in path
     # Allow only alphanumeric, underscore, hyphen, dot, forward slash
@@ -109,14 +110,12 @@ class DuckDBLoader:
             )
         """)
     
-    def load_tracks(self, csv_file):
+    def load_tracks(self, parquet_file):
         # Validate path to prevent SQL injection
-        safe_path = validate_csv_path(csv_file)
+        safe_path = validate_parquet_path(parquet_file)
 
-        # Get count before insert
-        count_before = self.conn.execute("SELECT COUNT(*) FROM raw_spotify_tracks").fetchone()[0]
-
-        self.conn.execute(f"""
+        # RETURNING yields only rows that were actually inserted
+        count = self.conn.execute(f"""
             INSERT INTO raw_spotify_tracks
             SELECT
                 played_at::TIMESTAMP,
@@ -132,21 +131,30 @@ class DuckDBLoader:
                 explicit,
                 track_uri,
                 CURRENT_TIMESTAMP as loaded_at
-            FROM read_csv_auto('{safe_path}')
+            FROM read_parquet('{safe_path}')
             ON CONFLICT DO NOTHING
-        """)
+            RETURNING track_id
+        """).arrow().num_rows
 
-        # Get count after insert to calculate difference
-        count_after = self.conn.execute("SELECT COUNT(*) FROM raw_spotify_tracks").fetchone()[0]
-        count = count_after - count_before
         logger.info(f"Loaded {count} new tracks from {os.path.basename(safe_path)}")
+
+        # Advance the extraction watermark only once plays are in the warehouse,
+        # so a failed load is re-fetched by the next extraction
+        max_played_at = self.conn.execute("SELECT MAX(played_at) FROM raw_spotify_tracks").fetchone()[0]
+        if max_played_at:
+            try:
+                write_watermark(max_played_at.isoformat())
+            except OSError as e:
+                # A stale watermark only makes the next extraction re-fetch the
+                # same window, so don't fail the remaining loads over it
+                logger.warning(f"Failed to update watermark (non-critical): {e}")
     
-    def load_artists(self, csv_file):
+    def load_artists(self, parquet_file):
         # Validate path to prevent SQL injection
-        safe_path = validate_csv_path(csv_file)
+        safe_path = validate_parquet_path(parquet_file)
 
         # Check if file has data
-        row_count = self.conn.execute(f"SELECT COUNT(*) FROM read_csv_auto('{safe_path}')").fetchone()[0]
+        row_count = self.conn.execute(f"SELECT COUNT(*) FROM read_parquet('{safe_path}')").fetchone()[0]
         if row_count == 0:
             logger.warning(f"Artists file is empty, skipping: {safe_path}")
             return
@@ -163,7 +171,7 @@ class DuckDBLoader:
                 popularity,
                 followers,
                 now() as loaded_at
-            FROM read_csv_auto('{safe_path}')
+            FROM read_parquet('{safe_path}')
             ON CONFLICT (artist_id) DO UPDATE SET
                 artist_name = EXCLUDED.artist_name,
                 genres = EXCLUDED.genres,
@@ -177,13 +185,13 @@ class DuckDBLoader:
         count = count_after - count_before
         logger.info(f"Loaded {count} new artists from {os.path.basename(safe_path)}")
     
-    def load_playlists(self, csv_file):
+    def load_playlists(self, parquet_file):
         # Validate path to prevent SQL injection
-        safe_path = validate_csv_path(csv_file)
+        safe_path = validate_parquet_path(parquet_file)
 
         # Check if file is empty
         if os.path.getsize(safe_path) == 0:
-            logger.warning(f"CSV file {safe_path} is empty, skipping...")
+            logger.warning(f"File {safe_path} is empty, skipping...")
             return
 
         # Get count before insert
@@ -203,7 +211,7 @@ class DuckDBLoader:
                 snapshot_id,
                 extracted_at,
                 now() as loaded_at
-            FROM read_csv_auto('{safe_path}')
+            FROM read_parquet('{safe_path}')
             ON CONFLICT (playlist_id) DO UPDATE SET
                 playlist_name = EXCLUDED.playlist_name,
                 owner_id = EXCLUDED.owner_id,
@@ -222,13 +230,13 @@ class DuckDBLoader:
         count = count_after - count_before
         logger.info(f"Loaded {count} new playlists from {os.path.basename(safe_path)}")
     
-    def load_playlist_tracks(self, csv_file):
+    def load_playlist_tracks(self, parquet_file):
         # Validate path to prevent SQL injection
-        safe_path = validate_csv_path(csv_file)
+        safe_path = validate_parquet_path(parquet_file)
 
         # Check if file is empty
         if os.path.getsize(safe_path) == 0:
-            logger.warning(f"CSV file {safe_path} is empty, skipping...")
+            logger.warning(f"File {safe_path} is empty, skipping...")
             return
 
         # Get count before insert
@@ -243,7 +251,7 @@ class DuckDBLoader:
                 added_by,
                 position,
                 now() as loaded_at
-            FROM read_csv_auto('{safe_path}')
+            FROM read_parquet('{safe_path}')
             ON CONFLICT (playlist_id, track_id) DO UPDATE SET
                 added_at = EXCLUDED.added_at,
                 added_by = EXCLUDED.added_by,
@@ -256,12 +264,12 @@ class DuckDBLoader:
         count = count_after - count_before
         logger.info(f"Loaded {count} new playlist tracks from {os.path.basename(safe_path)}")
     
-    def load_latest_csv_files(self, data_dir='/opt/airflow/data/raw'):
+    def load_latest_files(self, data_dir='/opt/airflow/data/raw'):
         # Find latest files (search recursively in organized directory structure)
-        track_files = sorted(glob.glob(f"{data_dir}/spotify_tracks/**/spotify_tracks_*.csv", recursive=True))
-        artist_files = sorted(glob.glob(f"{data_dir}/spotify_artists/**/spotify_artists_*.csv", recursive=True))
-        playlist_files = sorted(glob.glob(f"{data_dir}/spotify_playlists/**/spotify_playlists_*.csv", recursive=True))
-        playlist_track_files = sorted(glob.glob(f"{data_dir}/spotify_playlist_tracks/**/spotify_playlist_tracks_*.csv", recursive=True))
+        track_files = sorted(glob.glob(f"{data_dir}/spotify_tracks/**/spotify_tracks_*.parquet", recursive=True))
+        artist_files = sorted(glob.glob(f"{data_dir}/spotify_artists/**/spotify_artists_*.parquet", recursive=True))
+        playlist_files = sorted(glob.glob(f"{data_dir}/spotify_playlists/**/spotify_playlists_*.parquet", recursive=True))
+        playlist_track_files = sorted(glob.glob(f"{data_dir}/spotify_playlist_tracks/**/spotify_playlist_tracks_*.parquet", recursive=True))
         
         loaded_count = 0
         
@@ -299,13 +307,13 @@ class DuckDBLoader:
 
 def load_to_duckdb():
     """
-    Load latest CSV files into DuckDB.
+    Load latest Parquet files into DuckDB.
     Raises exception on critical failures.
     """
     loader = None
     try:
         loader = DuckDBLoader()
-        loader.load_latest_csv_files()
+        loader.load_latest_files()
         logger.info("DuckDB load completed successfully")
     except ValueError as e:
         logger.error(f"Validation error during load: {e}")
@@ -2,16 +2,139 @@
 Load Spotify Extended Streaming History JSON files into DuckDB
 """
 
-import json
 import glob
+import json
 import os
 import logging
-import pandas as pd
 import duckdb
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Declared JSON schema for the export (same order and types as the raw table),
+# so DuckDB skips type sampling and files missing a key read it as NULL
+EXTENDED_HISTORY_JSON_COLUMNS = """{
+    'ts': 'TIMESTAMP',
+    'platform': 'VARCHAR',
+    'ms_played': 'INTEGER',
+    'conn_country': 'VARCHAR',
+    'ip_addr': 'VARCHAR',
+    'master_metadata_track_name': 'VARCHAR',
+    'master_metadata_album_artist_name': 'VARCHAR',
+    'master_metadata_album_album_name': 'VARCHAR',
+    'spotify_track_uri': 'VARCHAR',
+    'episode_name': 'VARCHAR',
+    'episode_show_name': 'VARCHAR',
+    'spotify_episode_uri': 'VARCHAR',
+    'audiobook_title': 'VARCHAR',
+    'audiobook_uri': 'VARCHAR',
+    'audiobook_chapter_uri': 'VARCHAR',
+    'audiobook_chapter_title': 'VARCHAR',
+    'reason_start': 'VARCHAR',
+    'reason_end': 'VARCHAR',
+    'shuffle': 'BOOLEAN',
+    'skipped': 'BOOLEAN',
+    'offline': 'BOOLEAN',
+    'offline_timestamp': 'BIGINT',
+    'incognito_mode': 'BOOLEAN'
+}"""
+
+
+def quote_literal(value):
+    """Quote a string as a SQL literal (COPY does not take bound parameters)"""
+    return "'" + value.replace("'", "''") + "'"
+
+
+def copy_snapshot(conn, json_files, snapshot_path):
+    """Write the music-track rows of json_files to a ZSTD Parquet file in one scan"""
+    # Episodes and audiobooks are filtered out in SQL (keep only music tracks),
+    # and each row keeps the name of the export file it came from
+    file_list = '[' + ', '.join(quote_literal(f) for f in json_files) + ']'
+    conn.execute(f"""
+        COPY (
+            SELECT
+                * EXCLUDE (filename),
+                regexp_extract(filename, '[^/]+$') AS source_file
+            FROM read_json({file_list}, format='array', filename=true,
+                           columns={EXTENDED_HISTORY_JSON_COLUMNS})
+            WHERE spotify_track_uri LIKE 'spotify:track:%'
+        ) TO {quote_literal(snapshot_path)} (FORMAT PARQUET, COMPRESSION ZSTD)
+    """)
+
+
+def find_readable_files(conn, json_files):
+    """Return the export files DuckDB can parse, logging and skipping the rest"""
+    readable_files = []
+    for json_file in json_files:
+        try:
+            conn.execute(
+                f"SELECT COUNT(*) FROM read_json(?, format='array', columns={EXTENDED_HISTORY_JSON_COLUMNS})",
+                [json_file]
+            ).fetchone()
+        except (duckdb.Error, OSError) as e:
+            logger.error(f"Failed to read {json_file}, skipping: {e}")
+            continue  # Skip this file, try the next one
+        readable_files.append(json_file)
+    return readable_files
+
+
+def write_snapshot(json_files, parquet_path, memory_limit):
+    """
+    Build the Parquet snapshot from the export files. Returns the number of
+    files it includes (0 if none were readable).
+
+    All files are read in one parallel scan. Only if that fails are they probed
+    one by one, so truncated or invalid files are skipped (as the per-file load
+    did) without a second parse of clean exports. Runs on its own in-memory
+    connection so a bad file can't abort the load transaction.
+    """
+    json_files = sorted(json_files)
+    tmp_path = parquet_path + '.tmp'
+    with duckdb.connect() as snapshot_conn:
+        snapshot_conn.execute("SET preserve_insertion_order=false")
+        snapshot_conn.execute(f"SET memory_limit='{memory_limit}'")
+        try:
+            copy_snapshot(snapshot_conn, json_files, tmp_path)
+        except duckdb.Error as e:
+            logger.warning(f"Export scan failed, checking files one by one: {e}")
+            json_files = find_readable_files(snapshot_conn, json_files)
+            if not json_files:
+                return 0
+            copy_snapshot(snapshot_conn, json_files, tmp_path)
+    # Only a completely written snapshot may ever count as fresh
+    os.replace(tmp_path, parquet_path)
+    return len(json_files)
+
+
+def source_manifest(json_files):
+    """Path, size and mtime of every export file, in a JSON-serialisable form"""
+    return [
+        [json_file, os.path.getsize(json_file), os.path.getmtime(json_file)]
+        for json_file in sorted(json_files)
+    ]
+
+
+def is_snapshot_fresh(parquet_path, manifest_path, json_files):
+    """
+    True if the Parquet snapshot exists and was built from exactly the current
+    export files. Comparing the stored file list (not just mtimes) catches
+    removed files and replacements that carry an older mtime.
+    """
+    if not os.path.exists(parquet_path) or not os.path.exists(manifest_path):
+        return False
+    try:
+        with open(manifest_path) as f:
+            return json.load(f) == source_manifest(json_files)
+    except (OSError, json.JSONDecodeError):
+        return False
+
+
+def write_manifest(manifest_path, json_files):
+    """Record the export files the snapshot was built from, replacing the file atomically"""
+    with open(manifest_path + '.tmp', 'w') as f:
+        json.dump(source_manifest(json_files), f)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
 
 def load_extended_streaming_history():
     """
@@ -21,6 +144,13 @@ def load_extended_streaming_history():
     # Paths (use env vars with fallbacks)
     extended_history_dir = os.getenv('EXTENDED_HISTORY_DIR', '/opt/airflow/data/extended_history')
     duckdb_path = os.getenv('DUCKDB_PATH', '/opt/airflow/data/duckdb/spotify.duckdb')
+    memory_limit = os.getenv('DUCKDB_MEMORY_LIMIT', '4GB')
+    # Snapshot lives with the DuckDB file, not in the user's export folder
+    parquet_path = os.getenv(
+        'EXTENDED_HISTORY_PARQUET',
+        os.path.join(os.path.dirname(duckdb_path), 'extended_history.parquet')
+    )
+    manifest_path = parquet_path + '.manifest.json'
 
     # Check if extended history directory exists
     if not os.path.exists(extended_history_dir):
@@ -28,7 +158,8 @@ def load_extended_streaming_history():
         return
 
     # Find all JSON files
-    json_files = glob.glob(f"{extended_history_dir}/Streaming_History_Audio_*.json")
+    json_glob = f"{extended_history_dir}/Streaming_History_Audio_*.json"
+    json_files = glob.glob(json_glob)
 
     if not json_files:
         logger.info(f"No streaming history JSON files found in {extended_history_dir}")
@@ -44,91 +175,81 @@ def load_extended_streaming_history():
         raise
     
     try:
-        # Check if table exists and has data
-        table_exists = conn.execute("""
-            SELECT COUNT(*) 
-            FROM information_schema.tables 
-            WHERE table_name = 'raw_spotify_extended_history'
-        """).fetchone()[0] > 0
-        
-        if table_exists:
-            result = conn.execute("""
-                SELECT COUNT(*) as count 
-                FROM raw_spotify_extended_history
-            """).fetchone()
-            
-            if result and result[0] > 0:
-                logger.info(f"Extended history already loaded ({result[0]:,} records)")
+        # Bulk-load tuning: row order is irrelevant for a raw table, and the
+        # JSON scan can use every core
+        conn.execute("SET preserve_insertion_order=false")
+        conn.execute(f"SET threads={os.cpu_count() or 1}")
+        conn.execute(f"SET memory_limit='{memory_limit}'")
+
+        # Create and fill the table in one transaction so it commits once
+        conn.execute("BEGIN TRANSACTION")
+        try:
+            # Create raw extended history table
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS raw_spotify_extended_history (
+                    ts TIMESTAMP,
+                    platform VARCHAR,
+                    ms_played INTEGER,
+                    conn_country VARCHAR,
+                    ip_addr VARCHAR,
+                    master_metadata_track_name VARCHAR,
+                    master_metadata_album_artist_name VARCHAR,
+                    master_metadata_album_album_name VARCHAR,
+                    spotify_track_uri VARCHAR,
+                    episode_name VARCHAR,
+                    episode_show_name VARCHAR,
+                    spotify_episode_uri VARCHAR,
+                    audiobook_title VARCHAR,
+                    audiobook_uri VARCHAR,
+                    audiobook_chapter_uri VARCHAR,
+                    audiobook_chapter_title VARCHAR,
+                    reason_start VARCHAR,
+                    reason_end VARCHAR,
+                    shuffle BOOLEAN,
+                    skipped BOOLEAN,
+                    offline BOOLEAN,
+                    offline_timestamp BIGINT,
+                    incognito_mode BOOLEAN,
+                    source_file VARCHAR,
+                    loaded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+            # Tables created before source_file existed get the column added
+            conn.execute("""
+                ALTER TABLE raw_spotify_extended_history
+                ADD COLUMN IF NOT EXISTS source_file VARCHAR
+            """)
+
+            # The table is guaranteed to exist now, so one count tells us if
+            # history was already loaded
+            existing_records = conn.execute("""
+                SELECT COUNT(*) FROM raw_spotify_extended_history
+            """).fetchone()[0]
+
+            if existing_records > 0:
+                logger.info(f"Extended history already loaded ({existing_records:,} records)")
                 logger.info("Skipping load - data already exists")
+                conn.execute("ROLLBACK")
                 return
         
-        # Create raw extended history table
-        conn.execute("""
-            CREATE TABLE IF NOT EXISTS raw_spotify_extended_history (
-                ts TIMESTAMP,
-                platform VARCHAR,
-                ms_played INTEGER,
-                conn_country VARCHAR,
-                ip_addr VARCHAR,
-                master_metadata_track_name VARCHAR,
-                master_metadata_album_artist_name VARCHAR,
-                master_metadata_album_album_name VARCHAR,
-                spotify_track_uri VARCHAR,
-                episode_name VARCHAR,
-                episode_show_name VARCHAR,
-                spotify_episode_uri VARCHAR,
-                audiobook_title VARCHAR,
-                audiobook_uri VARCHAR,
-                audiobook_chapter_uri VARCHAR,
-                audiobook_chapter_title VARCHAR,
-                reason_start VARCHAR,
-                reason_end VARCHAR,
-                shuffle BOOLEAN,
-                skipped BOOLEAN,
-                offline BOOLEAN,
-                offline_timestamp BIGINT,
-                incognito_mode BOOLEAN,
-                loaded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        
-        total_records = 0
-        
-        # Load each JSON file with batch inserts
-        for json_file in sorted(json_files):
-            logger.info(f"Loading {os.path.basename(json_file)}...")
-
-            try:
-                with open(json_file, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-            except json.JSONDecodeError as e:
-                logger.error(f"Invalid JSON in {json_file}: {e}")
-                continue  # Skip this file, try the next one
-            except IOError as e:
-                logger.error(f"Failed to read {json_file}: {e}")
-                continue
-
-            # Filter out episodes and audiobooks (keep only music tracks)
-            music_data = [
-                record for record in data
-                if record.get('spotify_track_uri') and record['spotify_track_uri'].startswith('spotify:track:')
-            ]
-
-            logger.info(f"Found {len(data)} total records, {len(music_data)} music tracks")
-
-            if not music_data:
-                continue
-            
-            # Convert to DataFrame for batch insert
-            df = pd.DataFrame(music_data)
-            
-            # Register DataFrame as temporary table to avoid DuckDB IndexError bug
-            # DuckDB's direct DataFrame handling (FROM df) has issues with certain DataFrame states,
-            # so registering it as a virtual table ensures reliable batch inserts
-            conn.register('temp_extended_history', df)
-            
-            # Batch insert from temporary table
-            conn.execute("""
+            # Convert the JSON export to a Parquet snapshot once. It is only
+            # rebuilt when the set of export files changes, so reloading into a fresh
+            # DuckDB file skips JSON parsing entirely
+            if not is_snapshot_fresh(parquet_path, manifest_path, json_files):
+                logger.info(f"Writing Parquet snapshot to {parquet_path}")
+                snapshot_files = write_snapshot(json_files, parquet_path, memory_limit)
+                if not snapshot_files:
+                    logger.error("No readable extended history files, nothing loaded")
+                    conn.execute("ROLLBACK")
+                    return
+                logger.info(f"Snapshot built from {snapshot_files} of {len(json_files)} files")
+                # All files are listed, so fixing a skipped file triggers a rebuild
+                write_manifest(manifest_path, json_files)
+            else:
+                logger.info(f"Using Parquet snapshot {parquet_path}")
+
+            # loaded_at is left out so the column DEFAULT fills it
+            total_records = conn.execute("""
                 INSERT INTO raw_spotify_extended_history 
                 (ts, platform, ms_played, conn_country, ip_addr,
                  master_metadata_track_name, master_metadata_album_artist_name,
@@ -137,40 +258,14 @@ def load_extended_streaming_history():
                  audiobook_title, audiobook_uri, audiobook_chapter_uri,
                  audiobook_chapter_title, reason_start, reason_end,
                  shuffle, skipped, offline, offline_timestamp, incognito_mode,
-                 loaded_at)
-                SELECT 
-                    ts::TIMESTAMP,
-                    platform,
-                    ms_played,
-                    conn_country,
-                    ip_addr,
-                    master_metadata_track_name,
-                    master_metadata_album_artist_name,
-                    master_metadata_album_album_name,
-                    spotify_track_uri,
-                    episode_name,
-                    episode_show_name,
-                    spotify_episode_uri,
-                    audiobook_title,
-                    audiobook_uri,
-                    audiobook_chapter_uri,
-                    audiobook_chapter_title,
-                    reason_start,
-                    reason_end,
-                    shuffle,
-                    skipped,
-                    offline,
-                    offline_timestamp,
-                    incognito_mode,
-                    CURRENT_TIMESTAMP
-                FROM temp_extended_history
-            """)
-            
-            # Unregister temporary table to free memory
-            conn.unregister('temp_extended_history')
-            
-            total_records += len(music_data)
-            logger.info(f"Loaded {len(music_data)} records from {os.path.basename(json_file)}")
+                 source_file)
+                SELECT *
+                FROM read_parquet(?)
+            """, [parquet_path]).fetchone()[0]
+            conn.execute("COMMIT")
+        except duckdb.Error:
+            conn.execute("ROLLBACK")
+            raise
         
         logger.info(f"Total records loaded: {total_records:,}")
     finally:
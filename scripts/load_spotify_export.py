@@ -2,8 +2,10 @@
 Load Spotify Extended Streaming History Export into DuckDB
 """
 
-import json
+import argparse
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
 import duckdb
 import glob
 import os
@@ -13,6 +15,22 @@ import logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Declared JSON schema for the export columns we keep, so DuckDB skips type
+# sampling and files missing a key read it as NULL.
+# ts and ms_played are read as text and TRY_CAST in SQL, so one malformed
+# record is dropped instead of aborting the whole scan
+EXPORT_JSON_COLUMNS = """{
+    'ts': 'VARCHAR',
+    'master_metadata_track_name': 'VARCHAR',
+    'master_metadata_album_artist_name': 'VARCHAR',
+    'master_metadata_album_album_name': 'VARCHAR',
+    'spotify_track_uri': 'VARCHAR',
+    'ms_played': 'VARCHAR'
+}"""
+
+# Plays shorter than this are treated as skips
+MIN_PLAY_DURATION_MS = 30000  # 30 seconds in ms
+
 
 def load_streaming_history(export_dir='data/raw/spotify_export'):
     # Find all streaming history files
@@ -25,59 +43,27 @@ def load_streaming_history(export_dir='data/raw/spotify_export'):
         logger.error(f"No streaming history files found in {export_dir}")
         return None
     
-    # Load all JSON files
-    all_plays = []
-    for file in sorted(json_files):
-        logger.info(f"Loading {file}...")
-        with open(file, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-            all_plays.extend(data)
-    
-    logger.info(f"Loaded {len(all_plays):,} total plays from export")
-    
-    # Convert to DataFrame
-    df = pd.DataFrame(all_plays)
-    
-    # Standardize column names (Spotify uses different naming in exports)
-    column_mapping = {
-        'ts': 'played_at',
-        'master_metadata_track_name': 'track_name',
-        'master_metadata_album_artist_name': 'artist_name',
-        'master_metadata_album_album_name': 'album_name',
-        'spotify_track_uri': 'track_uri',
-        'ms_played': 'duration_ms'
-    }
-    
-    df = df.rename(columns=column_mapping)
-    
-    # Extract track_id from URI
-    if 'track_uri' in df.columns:
-        df['track_id'] = df['track_uri'].str.split(':').str[-1]
-    
-    # Convert timestamp to datetime
-    if 'played_at' in df.columns:
-        df['played_at'] = pd.to_datetime(df['played_at'])
-    
-    # Filter out skipped songs (played less than 30 seconds)
-    min_play_duration = 30000  # 30 seconds in ms
-    if 'duration_ms' in df.columns:
-        before_count = len(df)
-        df = df[df['duration_ms'] >= min_play_duration]
-    
-    # Select relevant columns
-    columns_to_keep = [
-        'played_at', 'track_id', 'track_name', 'artist_name', 
-        'album_name', 'duration_ms', 'track_uri'
-    ]
-    
-    available_columns = [col for col in columns_to_keep if col in df.columns]
-    df = df[available_columns]
-    
-    # Remove duplicates
-    df = df.drop_duplicates()
-    
-    # Sort by date
-    df = df.sort_values('played_at')
+    # Let DuckDB scan the files and do all the cleanup in one pass:
+    # - keep only music tracks and drop skipped songs (played < 30 seconds)
+    # - rename to our standard column names (Spotify uses different naming in exports)
+    # - extract track_id from the URI, remove duplicates and sort by date
+    # The DataFrame keeps Arrow-backed, already typed columns, so load_to_duckdb
+    # scans them without converting Python objects or casting again
+    df = duckdb.execute(f"""
+        SELECT DISTINCT
+            TRY_CAST(ts AS TIMESTAMP) AS played_at,
+            SUBSTRING(spotify_track_uri, 15) AS track_id,  -- Skip "spotify:track:"
+            master_metadata_track_name AS track_name,
+            master_metadata_album_artist_name AS artist_name,
+            master_metadata_album_album_name AS album_name,
+            TRY_CAST(ms_played AS INTEGER) AS duration_ms,
+            spotify_track_uri AS track_uri
+        FROM read_json(?, format='array', columns={EXPORT_JSON_COLUMNS})
+        WHERE spotify_track_uri LIKE 'spotify:track:%'
+            AND TRY_CAST(ts AS TIMESTAMP) IS NOT NULL
+            AND TRY_CAST(ms_played AS INTEGER) >= ?
+        ORDER BY played_at
+    """, [sorted(json_files), MIN_PLAY_DURATION_MS]).arrow().to_pandas(types_mapper=pd.ArrowDtype)
     
     logger.info(f"Processed {len(df):,} valid plays")
     return df
@@ -85,7 +71,9 @@ def load_streaming_history(export_dir='data/raw/spotify_export'):
 
 def save_to_csv(df, output_file='data/raw/spotify_export_processed.csv'):
     os.makedirs(os.path.dirname(output_file), exist_ok=True)
-    df.to_csv(output_file, index=False)
+    # pyarrow's C++ writer instead of pandas' per-value Python formatting
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    pacsv.write_csv(table, output_file)
     logger.info(f"Saved to {output_file}")
     return output_file
 
@@ -93,57 +81,89 @@ def save_to_csv(df, output_file='data/raw/spotify_export_processed.csv'):
 def load_to_duckdb(df, db_path='/opt/airflow/data/duckdb/spotify.duckdb'):
     conn = duckdb.connect(db_path)
     
-    # Create table if not exists (similar to raw_spotify_tracks)
-    conn.execute("""
-        CREATE TABLE IF NOT EXISTS raw_spotify_tracks_historical (
-            played_at TIMESTAMP,
-            track_id VARCHAR,
-            track_name VARCHAR,
-            artist_name VARCHAR,
-            album_name VARCHAR,
-            duration_ms INTEGER,
-            track_uri VARCHAR,
-            loaded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            PRIMARY KEY (track_id, played_at)
-        )
-    """)
+    try:
+        # Create table if not exists (similar to raw_spotify_tracks).
+        # The (track_id, played_at) key is enforced by a unique index built
+        # after the load, so the initial bulk insert doesn't maintain it per row
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS raw_spotify_tracks_historical (
+                played_at TIMESTAMP NOT NULL,
+                track_id VARCHAR NOT NULL,
+                track_name VARCHAR,
+                artist_name VARCHAR,
+                album_name VARCHAR,
+                duration_ms INTEGER,
+                track_uri VARCHAR,
+                loaded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        
+        # Insert and count in one transaction so the load commits once and
+        # the reported total includes the new rows
+        conn.execute("BEGIN TRANSACTION")
+        try:
+            # Insert only plays whose key isn't loaded yet (loaded_at is left
+            # out so the column DEFAULT fills it).
+            # RETURNING yields the inserted rows, so no before/after COUNT(*)
+            # is needed to find the new ones
+            new_records = conn.execute("""
+                INSERT INTO raw_spotify_tracks_historical
+                (played_at, track_id, track_name, artist_name, album_name,
+                 duration_ms, track_uri)
+                SELECT DISTINCT ON (played_at, track_id)
+                    played_at,
+                    track_id,
+                    track_name,
+                    artist_name,
+                    album_name,
+                    duration_ms,
+                    track_uri
+                FROM df
+                WHERE NOT EXISTS (
+                    SELECT 1
+                    FROM raw_spotify_tracks_historical existing
+                    WHERE existing.track_id = df.track_id
+                        AND existing.played_at = df.played_at
+                )
+                RETURNING track_id
+            """).arrow().num_rows
+            
+            # Build the key index once the bulk data is in. DuckDB 0.10 doesn't
+            # honour IF NOT EXISTS on CREATE INDEX, so look it up first.
+            # Legacy tables keep their PRIMARY KEY (track_id, played_at), which
+            # already enforces the key, so no second index is added for them
+            key_enforced = conn.execute("""
+                SELECT
+                    (SELECT COUNT(*) FROM duckdb_indexes()
+                     WHERE index_name = 'raw_spotify_tracks_historical_key')
+                    + (SELECT COUNT(*) FROM duckdb_constraints()
+                       WHERE table_name = 'raw_spotify_tracks_historical'
+                         AND constraint_type IN ('PRIMARY KEY', 'UNIQUE')
+                         AND list_sort(constraint_column_names) = ['played_at', 'track_id'])
+            """).fetchone()[0]
+            if not key_enforced:
+                conn.execute("""
+                    CREATE UNIQUE INDEX raw_spotify_tracks_historical_key
+                    ON raw_spotify_tracks_historical (track_id, played_at)
+                """)
+            
+            total_records = conn.execute(
+                "SELECT COUNT(*) FROM raw_spotify_tracks_historical"
+            ).fetchone()[0]
+            conn.execute("COMMIT")
+        except duckdb.Error:
+            conn.execute("ROLLBACK")
+            raise
+    finally:
+        conn.close()
     
-    # Count before
-    count_before = conn.execute(
-        "SELECT COUNT(*) FROM raw_spotify_tracks_historical"
-    ).fetchone()[0]
-    
-    # Insert data
-    conn.execute("""
-        INSERT INTO raw_spotify_tracks_historical
-        SELECT 
-            played_at::TIMESTAMP,
-            track_id,
-            track_name,
-            artist_name,
-            album_name,
-            duration_ms,
-            track_uri,
-            CURRENT_TIMESTAMP as loaded_at
-        FROM df
-        ON CONFLICT DO NOTHING
-    """)
-    
-    # Count after
-    count_after = conn.execute(
-        "SELECT COUNT(*) FROM raw_spotify_tracks_historical"
-    ).fetchone()[0]
-    
-    new_records = count_after - count_before
     logger.info(f"Inserted {new_records:,} new historical records")
-    logger.info(f"Total historical records: {count_after:,}")
-    
-    conn.close()
+    logger.info(f"Total historical records: {total_records:,}")
     
     return new_records
 
 
-def main():
+def main(export_csv=False):
     export_dir = 'data/raw/spotify_export'
     
     # Check if directory exists
@@ -157,8 +177,9 @@ def main():
     if df is None or df.empty:
         return
     
-    # Save processed CSV
-    csv_file = save_to_csv(df)
+    # Save processed CSV only when asked; DuckDB reads the DataFrame directly
+    if export_csv:
+        save_to_csv(df)
     
     # Load to DuckDB
     load_to_duckdb(df)
@@ -166,4 +187,7 @@ def main():
     print("Historical data loaded successfully.")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Load a Spotify streaming history export into DuckDB")
+    parser.add_argument('--export-csv', action='store_true', help="also save the processed plays to CSV")
+    args = parser.parse_args()
+    main(export_csv=args.export_csv)
\ No newline at end of file
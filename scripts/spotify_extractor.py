@@ -8,12 +8,19 @@ Supports two authentication methods:
 
 import spotipy
 from spotipy.oauth2 import SpotifyOAuth
+from spotipy.cache_handler import CacheFileHandler
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import pandas as pd
 from datetime import datetime
+from utils import read_watermark
 import os
 import json
 import logging
-import time
+import sqlite3
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -21,6 +28,52 @@ logger = logging.getLogger(__name__)
 # Spotify OAuth scopes needed
 SPOTIFY_SCOPES = 'user-read-recently-played user-top-read user-library-read playlist-read-private playlist-read-collaborative'
 
+# Concurrent playlist-track fetches (kept small to stay inside Spotify's rate limit)
+PLAYLIST_FETCH_WORKERS = 4
+
+# Keep-alive pool large enough for every playlist worker and its page prefetch,
+# plus the artist lookup that runs on the main thread at the same time
+HTTP_POOL_SIZE = PLAYLIST_FETCH_WORKERS * 2 + 1
+
+# Server-side projection for playlist tracks: only the fields that are stored
+PLAYLIST_TRACK_FIELDS = 'items(added_at,added_by.id,track.id),next'
+
+# Flattened recently-played fields -> raw_spotify_tracks columns
+# (artist_id/artist_name come from the first artist and are added separately)
+RECENTLY_PLAYED_FIELDS = {
+    'played_at': 'played_at',
+    'track.id': 'track_id',
+    'track.name': 'track_name',
+    'track.album.id': 'album_id',
+    'track.album.name': 'album_name',
+    'track.album.release_date': 'album_release_date',
+    'track.duration_ms': 'duration_ms',
+    'track.popularity': 'popularity',
+    'track.explicit': 'explicit',
+    'track.uri': 'track_uri'
+}
+
+# Column order of the tracks file (matches raw_spotify_tracks)
+RECENTLY_PLAYED_COLUMNS = [
+    'played_at', 'track_id', 'track_name', 'artist_id', 'artist_name',
+    'album_id', 'album_name', 'album_release_date', 'duration_ms',
+    'popularity', 'explicit', 'track_uri'
+]
+
+# On-disk cache of artist rows, so popular artists aren't re-fetched every run
+ARTIST_CACHE_PATH = os.getenv('SPOTIFY_ARTIST_CACHE_PATH', '/opt/airflow/data/.artist_cache.sqlite')
+ARTIST_CACHE_TTL_DAYS = 7
+
+# Column order of the artists, playlists and playlist_tracks files
+ARTIST_COLUMNS = ['artist_id', 'artist_name', 'genres', 'popularity', 'followers']
+
+PLAYLIST_COLUMNS = [
+    'playlist_id', 'playlist_name', 'owner_id', 'is_owner', 'is_public',
+    'is_collaborative', 'total_tracks', 'description', 'snapshot_id', 'extracted_at'
+]
+
+PLAYLIST_TRACK_COLUMNS = ['playlist_id', 'track_id', 'added_at', 'added_by', 'position']
+
 
 def get_spotify_credentials():
     """
@@ -66,6 +119,62 @@ def get_spotify_credentials():
     return client_id, client_secret, redirect_uri, refresh_token
 
 
+class InMemoryCacheHandler(CacheFileHandler):
+    """
+    Token cache that keeps the token in memory between API calls.
+
+    The cache file is only re-read when its modification time changes, so the
+    per-request token check is a stat() instead of a JSON file read.
+    """
+
+    def __init__(self, cache_path):
+        super().__init__(cache_path=cache_path)
+        self._token_info = None
+        self._mtime = None
+
+    def get_cached_token(self):
+        try:
+            mtime = os.path.getmtime(self.cache_path)
+        except OSError:
+            return self._token_info
+
+        if self._token_info is None or mtime != self._mtime:
+            self._token_info = super().get_cached_token()
+            self._mtime = mtime
+        return self._token_info
+
+    def save_token_to_cache(self, token_info):
+        super().save_token_to_cache(token_info)
+        self._token_info = token_info
+        try:
+            self._mtime = os.path.getmtime(self.cache_path)
+        except OSError:
+            self._mtime = None
+
+
+def build_http_session():
+    """
+    Build the requests session used for Spotify API calls.
+
+    Connections are pooled and kept alive across calls, and throttled or failed
+    requests are retried with backoff, waiting out Spotify's Retry-After header.
+    """
+    retry = Retry(
+        total=5,
+        read=False,
+        allowed_methods=frozenset(['GET', 'POST', 'PUT', 'DELETE']),
+        backoff_factor=0.5,
+        status_forcelist=[429, 500, 502, 503, 504],
+        respect_retry_after_header=True
+    )
+    adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE, max_retries=retry)
+
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
 class SpotifyExtractor:
     """
     Extracts data from Spotify API.
@@ -89,7 +198,7 @@ class SpotifyExtractor:
             client_secret=client_secret,
             redirect_uri=redirect_uri,
             scope=SPOTIFY_SCOPES,
-            cache_path=cache_path,
+            cache_handler=InMemoryCacheHandler(cache_path),
             open_browser=False
         )
 
@@ -107,183 +216,220 @@ class SpotifyExtractor:
                 "Run authenticate_spotify.py locally first."
             )
 
-        self.sp = spotipy.Spotify(auth_manager=auth_manager)
+        self.sp = spotipy.Spotify(auth_manager=auth_manager, requests_session=build_http_session())
 
-        # Test the connection
-        user = self.sp.current_user()
-        if not user:
+        # Test the connection; the profile is kept for later user_id lookups
+        self._user = self.sp.current_user()
+        if not self._user:
             raise Exception("Failed to authenticate with Spotify")
-        logger.info(f"Authenticated as Spotify user: {user.get('display_name', user.get('id'))}")
+        logger.info(f"Authenticated as Spotify user: {self._user.get('display_name', self._user.get('id'))}")
     
-    def get_recently_played(self, limit=50):
-        results = self.sp.current_user_recently_played(limit=limit)
-        tracks_data = []
+    def get_recently_played(self, limit=50, after=None):
+        # after: Unix ms cursor; only plays later than it are returned
+        results = self.sp.current_user_recently_played(limit=limit, after=after)
+        items = []
+        # Primary artist IDs, collected here so callers don't re-scan the frame
+        self._seen_artists = set()
         
         for item in results['items']:
             track = item['track']
             if not track:
                 continue
 
-            played_at = item['played_at']
-
-            # Safely extract artist info - some tracks may have no artists
-            artists = track.get('artists', [])
-            if not artists:
+            # Some tracks may have no artists
+            if not track.get('artists'):
                 logger.warning(f"Track {track.get('id')} has no artists, skipping")
                 continue
 
-            primary_artist = artists[0]
-
-            tracks_data.append({
-                'played_at': played_at,
-                'track_id': track['id'],
-                'track_name': track['name'],
-                'artist_id': primary_artist.get('id'),
-                'artist_name': primary_artist.get('name'),
-                'album_id': track.get('album', {}).get('id'),
-                'album_name': track.get('album', {}).get('name'),
-                'album_release_date': track.get('album', {}).get('release_date'),
-                'duration_ms': track.get('duration_ms'),
-                'popularity': track.get('popularity'),
-                'explicit': track.get('explicit'),
-                'track_uri': track.get('uri')
-            })
+            items.append(item)
+            if track['artists'][0].get('id'):
+                self._seen_artists.add(track['artists'][0]['id'])
+        
+        if not items:
+            logger.info("Extracted 0 recently played tracks")
+            return pd.DataFrame(columns=RECENTLY_PLAYED_COLUMNS)
+
+        # Flatten the nested track/album fields in one pass; fields missing
+        # from every item come back as empty columns
+        flat = pd.json_normalize(items).reindex(columns=[*RECENTLY_PLAYED_FIELDS, 'track.artists'])
+        primary_artist = flat['track.artists'].str[0]
+
+        df = flat[list(RECENTLY_PLAYED_FIELDS)].rename(columns=RECENTLY_PLAYED_FIELDS)
+        df.insert(3, 'artist_id', primary_artist.str.get('id'))
+        df.insert(4, 'artist_name', primary_artist.str.get('name'))
+        df['artist_id'] = df['artist_id'].astype('category')
         
-        df = pd.DataFrame(tracks_data)
         logger.info(f"Extracted {len(df)} recently played tracks")
         return df
     
     def get_artist_info(self, artist_ids):
         artists_data = []
-        # API allows max 50 artists per request
-        for i in range(0, len(artist_ids), 50):
-            batch = artist_ids[i:i+50]
-            results = self.sp.artists(batch)
+        cache_hits = 0
+        
+        with closing(sqlite3.connect(ARTIST_CACHE_PATH)) as cache:
+            cache.execute("""
+                CREATE TABLE IF NOT EXISTS artists (
+                    artist_id TEXT PRIMARY KEY,
+                    data TEXT,
+                    fetched_at TIMESTAMP
+                )
+            """)
             
-            for artist in results['artists']:
-                if artist:  # Some artists might be None
-                    artists_data.append({
-                        'artist_id': artist['id'],
-                        'artist_name': artist['name'],
-                        'genres': ','.join(artist.get('genres', [])),
-                        'popularity': artist['popularity'],
-                        'followers': artist['followers']['total']
-                    })
+            # API allows max 50 artists per request
+            for i in range(0, len(artist_ids), 50):
+                batch = artist_ids[i:i+50]
+                
+                # Reuse rows fetched within the TTL; only request the rest
+                cached = dict(cache.execute(
+                    f"SELECT artist_id, data FROM artists "
+                    f"WHERE artist_id IN ({','.join('?' * len(batch))}) AND fetched_at > datetime('now', ?)",
+                    [*batch, f'-{ARTIST_CACHE_TTL_DAYS} days']
+                ).fetchall())
+                artists_data.extend(tuple(json.loads(data)) for data in cached.values())
+                cache_hits += len(cached)
+                
+                misses = [artist_id for artist_id in batch if artist_id not in cached]
+                if not misses:
+                    continue
+                
+                results = self.sp.artists(misses)
+                fetched = []
+                for artist in results['artists']:
+                    if artist:  # Some artists might be None
+                        row = (
+                            artist['id'],
+                            artist['name'],
+                            ','.join(artist.get('genres', [])),
+                            artist['popularity'],
+                            artist['followers']['total']
+                        )
+                        artists_data.append(row)
+                        fetched.append((artist['id'], json.dumps(row)))
+                
+                cache.executemany(
+                    "INSERT OR REPLACE INTO artists VALUES (?, ?, CURRENT_TIMESTAMP)",
+                    fetched
+                )
+                cache.commit()
         
-        df = pd.DataFrame(artists_data)
-        logger.info(f"Extracted info for {len(df)} artists")
+        df = pd.DataFrame(artists_data, columns=ARTIST_COLUMNS)
+        logger.info(f"Extracted info for {len(df)} artists ({cache_hits} from cache)")
         return df
     
+    def _paginate(self, page):
+        """
+        Yield the items of a paged API response, following its next links.
+
+        The next page is requested in the background while the current page's
+        items are being processed.
+        """
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            while page:
+                next_page = executor.submit(self.sp.next, page) if page.get('next') else None
+                yield from page['items']
+                page = next_page.result() if next_page else None
+    
+    def get_playlist_tracks(self, playlist_id):
+        playlist_tracks_data = []
+        
+        # Get tracks for this playlist; positions run across pages
+        first_page = self.sp.playlist_tracks(playlist_id, fields=PLAYLIST_TRACK_FIELDS, limit=100)
+        
+        for position, item in enumerate(self._paginate(first_page)):
+            if not item or not item.get('track'):
+                continue
+            
+            track = item['track']
+            if not track or not track.get('id'):
+                continue
+            
+            added_by = item.get('added_by')
+            playlist_tracks_data.append((
+                playlist_id,
+                track['id'],
+                item.get('added_at'),
+                added_by.get('id') if added_by else None,
+                position
+            ))
+        
+        return playlist_tracks_data
+    
     def get_user_playlists(self):
         playlists_data = []
+        playlist_ids = []
         playlist_tracks_data = []
         
-        # Get current user ID
-        user = self.sp.current_user()
-        user_id = user['id']
+        # Current user ID (fetched once during authentication)
+        user_id = self._user['id']
+        # One timestamp for the whole extraction
+        extracted_at = datetime.now()
         
         # Get all playlists (handle pagination)
-        offset = 0
-        limit = 50
+        first_page = self.sp.current_user_playlists(limit=50)
         
-        while True:
-            playlists = self.sp.current_user_playlists(limit=limit, offset=offset)
-            
-            if not playlists['items']:
-                break
+        for playlist in self._paginate(first_page):
+            if not playlist:  # Skip None items
+                continue
             
-            for playlist in playlists['items']:
-                if not playlist:  # Skip None items
-                    continue
-                
-                playlist_id = playlist['id']
-                playlist_name = playlist['name']
-                playlist_owner = playlist['owner']['id']
-                is_public = playlist['public']
-                is_collaborative = playlist['collaborative']
-                total_tracks = playlist['tracks']['total']
-                
-                # Store playlist metadata
-                playlists_data.append({
-                    'playlist_id': playlist_id,
-                    'playlist_name': playlist_name,
-                    'owner_id': playlist_owner,
-                    'is_owner': (playlist_owner == user_id),
-                    'is_public': is_public,
-                    'is_collaborative': is_collaborative,
-                    'total_tracks': total_tracks,
-                    'description': playlist.get('description', ''),
-                    'snapshot_id': playlist.get('snapshot_id', ''),
-                    'extracted_at': datetime.now()
-                })
-                
-                # Get tracks for this playlist
-                track_offset = 0
-                track_limit = 100
-                
-                while True:
-                    playlist_tracks = self.sp.playlist_tracks(
-                        playlist_id,
-                        limit=track_limit,
-                        offset=track_offset
-                    )
-                    
-                    if not playlist_tracks['items']:
-                        break
-                    
-                    for item in playlist_tracks['items']:
-                        if not item or not item.get('track'):
-                            continue
-                        
-                        track = item['track']
-                        if not track or not track.get('id'):
-                            continue
-                        
-                        playlist_tracks_data.append({
-                            'playlist_id': playlist_id,
-                            'track_id': track['id'],
-                            'added_at': item.get('added_at'),
-                            'added_by': item.get('added_by', {}).get('id') if item.get('added_by') else None,
-                            'position': track_offset + playlist_tracks['items'].index(item)
-                        })
-                    
-                    if not playlist_tracks['next']:
-                        break
-                    track_offset += track_limit
+            playlist_id = playlist['id']
+            playlist_name = playlist['name']
+            playlist_owner = playlist['owner']['id']
+            is_public = playlist['public']
+            is_collaborative = playlist['collaborative']
+            total_tracks = playlist['tracks']['total']
             
-            if not playlists['next']:
-                break
-            offset += limit
+            # Store playlist metadata
+            playlists_data.append((
+                playlist_id,
+                playlist_name,
+                playlist_owner,
+                (playlist_owner == user_id),
+                is_public,
+                is_collaborative,
+                total_tracks,
+                playlist.get('description', ''),
+                playlist.get('snapshot_id', ''),
+                extracted_at
+            ))
+            playlist_ids.append(playlist_id)
+        
+        # Fetch each playlist's tracks concurrently; the calls are I/O-bound
+        # and map() keeps the results in playlist order
+        with ThreadPoolExecutor(max_workers=PLAYLIST_FETCH_WORKERS) as executor:
+            for tracks in executor.map(self.get_playlist_tracks, playlist_ids):
+                playlist_tracks_data.extend(tracks)
         
-        playlists_df = pd.DataFrame(playlists_data)
-        playlist_tracks_df = pd.DataFrame(playlist_tracks_data)
+        playlists_df = pd.DataFrame(playlists_data, columns=PLAYLIST_COLUMNS)
+        playlist_tracks_df = pd.DataFrame(playlist_tracks_data, columns=PLAYLIST_TRACK_COLUMNS)
+        # Playlist and track IDs repeat across many rows; store each string once
+        for column in ('playlist_id', 'track_id'):
+            playlist_tracks_df[column] = playlist_tracks_df[column].astype('category')
         
         logger.info(f"Extracted {len(playlists_df)} playlists with {len(playlist_tracks_df)} track relationships")
         return playlists_df, playlist_tracks_df
     
-    def save_to_csv(self, df, filename, output_dir='/opt/airflow/data/raw'):
-        timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-        
-        # Extract year, month, day from timestamp (format: YYYYMMDD_HHMMSS)
-        year = timestamp[:4]
-        month = timestamp[4:6]
-        day = timestamp[6:8]
+    def save_to_parquet(self, df, filename, output_dir='/opt/airflow/data/raw', run_at=None):
+        # run_at lets all files from one extraction share a timestamp
+        now = run_at or datetime.now()
+        timestamp = now.strftime('%Y%m%d_%H%M%S')
+        year, month, day = now.strftime('%Y'), now.strftime('%m'), now.strftime('%d')
         
         # Create directory structure: {category}/{year}/{month}/{day}/
         category_dir = os.path.join(output_dir, filename, year, month, day)
         os.makedirs(category_dir, exist_ok=True)
         
-        filepath = os.path.join(category_dir, f"{filename}_{timestamp}.csv")
+        filepath = os.path.join(category_dir, f"{filename}_{timestamp}.parquet")
         
-        df.to_csv(filepath, index=False)
+        df.to_parquet(filepath, engine='pyarrow', compression='zstd', index=False)
         logger.info(f"Saved {len(df)} records to {filepath}")
         return filepath
 
 
 def extract_spotify_data():
     """
-    Extract data from Spotify API and save to CSV files.
-    Returns dict with file paths on success, None on failure.
+    Extract data from Spotify API and save to Parquet files.
+    Returns dict with file paths (None for sources that were skipped).
+    Raises exception on critical failures.
     """
     try:
         extractor = SpotifyExtractor()
@@ -292,64 +438,77 @@ def extract_spotify_data():
         raise
 
     result = {}
+    # Shared by every file from this run, so they land in the same partition
+    run_at = datetime.now()
+
+    # Only ask for plays newer than the latest one already loaded into DuckDB
+    last_played_at = read_watermark()
+    after = int(pd.Timestamp(last_played_at).timestamp() * 1000) if last_played_at else None
 
     try:
         # Extract recently played tracks
-        tracks_df = extractor.get_recently_played(limit=50)
+        tracks_df = extractor.get_recently_played(limit=50, after=after)
     except Exception as e:
         logger.error(f"Failed to get recently played tracks: {e}")
         raise
 
     if tracks_df.empty:
-        logger.warning("No tracks found")
-        return None
+        # Nothing new to save, but playlists still get refreshed below
+        logger.warning(f"No new tracks since {last_played_at}" if last_played_at else "No tracks found")
+        result['tracks_file'] = None
 
-    try:
-        # Save tracks
-        tracks_file = extractor.save_to_csv(tracks_df, 'spotify_tracks')
-        result['tracks_file'] = tracks_file
-    except Exception as e:
-        logger.error(f"Failed to save tracks CSV: {e}")
-        raise
+    # Playlists don't depend on the tracks, so fetch them in the background
+    # while the tracks are saved and the artists are looked up
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        playlists_future = executor.submit(extractor.get_user_playlists)
 
-    # Extract artist information (non-critical, continue on failure)
-    try:
-        artist_ids = tracks_df['artist_id'].dropna().unique().tolist()
-        if artist_ids:
-            artists_df = extractor.get_artist_info(artist_ids)
-            if not artists_df.empty:
-                artists_file = extractor.save_to_csv(artists_df, 'spotify_artists')
-                result['artists_file'] = artists_file
+        if not tracks_df.empty:
+            try:
+                # Save tracks (the loader advances the watermark once they're in DuckDB)
+                tracks_file = extractor.save_to_parquet(tracks_df, 'spotify_tracks', run_at=run_at)
+                result['tracks_file'] = tracks_file
+            except Exception as e:
+                logger.error(f"Failed to save tracks file: {e}")
+                raise
+
+        # Extract artist information (non-critical, continue on failure)
+        try:
+            artist_ids = list(extractor._seen_artists)
+            if artist_ids:
+                artists_df = extractor.get_artist_info(artist_ids)
+                if not artists_df.empty:
+                    artists_file = extractor.save_to_parquet(artists_df, 'spotify_artists', run_at=run_at)
+                    result['artists_file'] = artists_file
+                else:
+                    logger.warning("Artist info not available (skipped)")
+                    result['artists_file'] = None
             else:
-                logger.warning("Artist info not available (skipped)")
+                logger.warning("No artist IDs to fetch")
                 result['artists_file'] = None
-        else:
-            logger.warning("No artist IDs to fetch")
+        except Exception as e:
+            logger.warning(f"Failed to get artist info (non-critical): {e}")
             result['artists_file'] = None
-    except Exception as e:
-        logger.warning(f"Failed to get artist info (non-critical): {e}")
-        result['artists_file'] = None
 
-    # Extract playlist information (non-critical, continue on failure)
-    try:
-        playlists_df, playlist_tracks_df = extractor.get_user_playlists()
-        if not playlists_df.empty:
-            playlists_file = extractor.save_to_csv(playlists_df, 'spotify_playlists')
-            result['playlists_file'] = playlists_file
-        else:
-            logger.warning("Playlists not available (skipped)")
-            result['playlists_file'] = None
+        # Extract playlist information (non-critical, continue on failure)
+        try:
+            playlists_df, playlist_tracks_df = playlists_future.result()
+            if not playlists_df.empty:
+                playlists_file = extractor.save_to_parquet(playlists_df, 'spotify_playlists', run_at=run_at)
+                result['playlists_file'] = playlists_file
+            else:
+                logger.warning("Playlists not available (skipped)")
+                result['playlists_file'] = None
 
-        if not playlist_tracks_df.empty:
-            playlist_tracks_file = extractor.save_to_csv(playlist_tracks_df, 'spotify_playlist_tracks')
-            result['playlist_tracks_file'] = playlist_tracks_file
-        else:
-            logger.warning("Playlist tracks not available (skipped)")
+            if not playlist_tracks_df.empty:
+                playlist_tracks_file = extractor.save_to_parquet(playlist_tracks_df, 'spotify_playlist_tracks', run_at=run_at)
+                result['playlist_tracks_file'] = playlist_tracks_file
+            else:
+                logger.warning("Playlist tracks not available (skipped)")
+                result['playlist_tracks_file'] = None
+        except Exception as e:
+            logger.warning(f"Failed to get playlist info (non-critical): {e}")
+            result['playlists_file'] = None
             result['playlist_tracks_file'] = None
-    except Exception as e:
-        logger.warning(f"Failed to get playlist info (non-critical): {e}")
-        result['playlists_file'] = None
-        result['playlist_tracks_file'] = None
 
     logger.info(f"Extraction complete: {sum(1 for v in result.values() if v)} of 4 data sources saved")
     return result
@@ -7,6 +7,10 @@ import logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Latest played_at loaded into raw_spotify_tracks; the extractor only asks the
+# API for plays after it
+WATERMARK_PATH = os.getenv('SPOTIFY_WATERMARK_PATH', '/opt/airflow/data/.last_played_at')
+
 
 def validate_env_vars():
     """Validate required environment variables"""
@@ -22,4 +26,21 @@ def validate_env_vars():
         raise ValueError(f"Missing required environment variables: {', '.join(missing)}")
     
     logger.info("All required environment variables are set")
-    return True
\ No newline at end of file
+    return True
+
+
+def read_watermark(path=WATERMARK_PATH):
+    """Return the last loaded played_at (ISO string), or None on the first run"""
+    try:
+        with open(path) as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def write_watermark(played_at, path=WATERMARK_PATH):
+    """Record the last loaded played_at, replacing the file atomically"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        f.write(played_at)
+    os.replace(tmp_path, path)